@@ -1,96 +1,140 @@
 #!/usr/bin/python3
 
 import datetime
-import json
+import hashlib
+import orjson
+import os
 import requests
 import pytimeparse
 import time
 import sys
 
 from tokent import TOKEN
-from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from itertools import groupby
 from operator import itemgetter
+from requests.adapters import HTTPAdapter
 
 
-class Formatter:
-    def __init__(self):
-        self.formatting_dict = {False: '{0:.0f}', True: '{0:.2f}'}
+REQUEST_TIMEOUT = 10
+FETCH_WORKERS = 16
+MESSAGE_BATCH_LIMIT = 4000
 
-    def __call__(self, value, fractional_scoring):
-        return self.formatting_dict[fractional_scoring].format(value)
 
-formatter = Formatter()
+def write_json(filename, obj, option=0):
+    tmp_filename = filename + '.tmp'
+    with open(tmp_filename, 'wb') as w:
+        w.write(orjson.dumps(obj, option = option | orjson.OPT_APPEND_NEWLINE))
+    os.replace(tmp_filename, filename)
+
+
+def make_session():
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=16)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+_fmt_int = '{0:.0f}'.format
+_fmt_frac = '{0:.2f}'.format
+
+
+def formatter(value, fractional_scoring):
+    return _fmt_frac(value) if fractional_scoring else _fmt_int(value)
 
 
 class Telegram:
-    def __init__(self, token):
+    def __init__(self, token, session):
         self.token = token
+        self.api_url = 'https://api.telegram.org/bot{}/'.format(token)
+        self.session = session
         try:
-            with open('pinned.json', 'r') as f:
-                self.config = json.load(f)
+            with open('pinned.json', 'rb') as f:
+                self.config = orjson.loads(f.read())
         except FileNotFoundError:
             self.config = {}
 
+    def _call(self, method, **params):
+        try:
+            return self.session.post(self.api_url + method, data=params, timeout=REQUEST_TIMEOUT)
+        except requests.RequestException as e:
+            print('Telegram request {} failed: {}'.format(method, e), file=sys.stderr)
+            return None
+
     def send_message(self, chat_id, message, pin=False):
-        r = requests.get(
-            'https://api.telegram.org/bot{}/sendMessage?text={}&chat_id={}'.format(
-                self.token,
-                message,
-                chat_id
-            )
-        )
+        r = self._call('sendMessage', chat_id=chat_id, text=message)
 
-        if r.status_code != 200:
+        if r is None or r.status_code != 200:
             print('Failed to send message to chat {}'.format(chat_id), file=sys.stderr)
-            return
+            return False
 
         if pin:
             message_id = r.json()['result']['message_id']
-            rx = requests.get(
-                'https://api.telegram.org/bot{}/pinChatMessage?chat_id={}&message_id={}'.format(
-                    self.token,
-                    chat_id,
-                    message_id
-                )
-            )
-
-            if rx.status_code != 200:
+            rx = self._call('pinChatMessage', chat_id=chat_id, message_id=message_id)
+
+            if rx is None or rx.status_code != 200:
                 print('Failed to pin message to chat {}'.format(chat_id), file=sys.stderr)
-                return
+                return True
 
             if chat_id not in self.config:
                 self.config[chat_id] = {}
             self.config[chat_id]['pinned_message_id'] = message_id
+        return True
+
+    def _send_batch(self, chat_id, batch):
+        if self.send_message(chat_id, '\n\n'.join(batch)) or len(batch) == 1:
+            return
+        for message in batch:
+            self.send_message(chat_id, message)
+
+    def send_messages(self, chat_id, messages):
+        batch, batch_len = [], 0
+        for message in messages:
+            if batch and batch_len + len(message) + 2 > MESSAGE_BATCH_LIMIT:
+                self._send_batch(chat_id, batch)
+                batch, batch_len = [], 0
+            batch_len += len(message) + (2 if batch else 0)
+            batch.append(message)
+        if batch:
+            self._send_batch(chat_id, batch)
 
     def edit_pinned_message(self, chat_id, message):
         if chat_id not in self.config:
             self.config[chat_id] = {}
+        message_hash = hashlib.blake2b(message.encode(), digest_size=8).hexdigest()
         if 'pinned_message_id' not in self.config[chat_id]:
             self.send_message(chat_id, message, pin = True)
+            if 'pinned_message_id' in self.config[chat_id]:
+                self.config[chat_id]['pinned_hash'] = message_hash
+            return
+        if self.config[chat_id].get('pinned_hash') == message_hash:
             return
 
-        r = requests.get(
-            'https://api.telegram.org/bot{}/editMessageText?chat_id={}&message_id={}&text={}'.format(
-                self.token,
-                chat_id,
-                self.config[chat_id]['pinned_message_id'],
-                message
-            )
+        r = self._call(
+            'editMessageText',
+            chat_id=chat_id,
+            message_id=self.config[chat_id]['pinned_message_id'],
+            text=message
         )
 
+        if r is None:
+            print('Failed to edit pinned message in chat {}'.format(chat_id))
+            return
         if r.status_code != 200:
             if 'Bad Request: message is not modified: specified new message content' not in r.text:
                 print('Failed to edit pinned message in chat {}'.format(chat_id))
                 return
+        self.config[chat_id]['pinned_hash'] = message_hash
 
     def flush(self):
-        with open('pinned.json', 'w') as w:
-            print(json.dumps(self.config), file = w)
+        write_json('pinned.json', self.config, option = orjson.OPT_NON_STR_KEYS)
 
 
 class DataFetcher:
-    def __init__(self, fetcher_config):
+    def __init__(self, fetcher_config, session):
         self.config = fetcher_config
+        self.session = session
 
     def fetch_data(self, login):
         return self._get_request('{}/sublist/{}'.format(self.config['scoreboard_url'], login))
@@ -103,11 +147,11 @@ class DataFetcher:
         retries = self.config['retries']
         for i in range(retries):
             try:
-                result = requests.get(url)
+                result = self.session.get(url, timeout=REQUEST_TIMEOUT)
                 if result.status_code != 200:
                     print(url, result.status_code)
                     continue
-                return result.json()
+                return orjson.loads(result.content)
             except:
                 print('GET request to {} failed'.format(url))
 
@@ -122,18 +166,18 @@ class State:
     def __init__(self, state_config):
         self.state_file = state_config['filename']
         try:
-            with open(self.state_file, 'r') as f:
-                json_state = json.load(f)
+            with open(self.state_file, 'rb') as f:
+                json_state = orjson.loads(f.read())
                 self.state = json_state['results']
                 self.submissions = json_state['submission']
         except FileNotFoundError:
             self.state = {}
             self.submissions = []
+        self._submission_set = set(self.submissions)
 
     def flush(self):
         json_state = {'results': self.state, 'submission': self.submissions}
-        with open(self.state_file, 'w') as w:
-            print(json.dumps(json_state), file = w)
+        write_json(self.state_file, json_state)
 
     def get_points(self, participant, problem, fractional_scoring):
         if participant not in self.state:
@@ -143,17 +187,25 @@ class State:
         return formatter(sum(self.state[participant][problem]), fractional_scoring)
 
     def has_submission(self, submission):
-        return submission['key'] in self.submissions
+        return submission['key'] in self._submission_set
 
     def add_submission(self, submission):
-        participant, problem, points = submission['user'], submission['task'], submission['extra']
-        if participant not in self.state:
-            self.state[participant] = {}
-        if problem not in self.state[participant]:
-            self.state[participant][problem] = [.0] * len(points)
-        for i in range(len(points)):
-            self.state[participant][problem][i] = max(self.state[participant][problem][i], float(points[i]))
+        problem, points = submission['task'], submission['extra']
+        part = self.state.setdefault(submission['user'], {})
+        vec = part.get(problem)
+        if vec is None:
+            vec = [.0] * len(points)
+            part[problem] = vec
+        old_total = sum(vec)
+        delta = .0
+        for i, p in enumerate(points):
+            v = float(p)
+            if v > vec[i]:
+                delta += v - vec[i]
+                vec[i] = v
         self.submissions.append(submission['key'])
+        self._submission_set.add(submission['key'])
+        return old_total, old_total + delta
 
 
 class Scoreboard:
@@ -166,67 +218,80 @@ class Scoreboard:
             return
 
         try:
-            with open('scoreboard.json', 'r') as f:
-                self.old_positions = json.load(f)
+            with open('scoreboard.json', 'rb') as f:
+                self.old_positions = orjson.loads(f.read())
         except FileNotFoundError:
             self.old_positions = {}
+        for id, pos in self.old_positions.items():
+            if isinstance(pos, str):
+                self.old_positions[id] = (int(pos.split('-')[0]), pos)
 
-        points = defaultdict(list)
-        for id, problem_stats in scores.items():
-            total_score = sum(problem_stats.values())
-            points[total_score].append(id)
+        totals = sorted(((sum(problem_stats.values()), id) for id, problem_stats in scores.items()), key = itemgetter(0), reverse = True)
         ptr = 0
-        for points, people in sorted(points.items(), key = itemgetter(0), reverse = True):
+        for _, group in groupby(totals, key = itemgetter(0)):
+            people = [id for _, id in group]
             ln = len(people)
+            position = (ptr + 1, '{}-{}'.format(ptr + 1, ptr + ln) if ln > 1 else str(ptr + 1))
             for id in people:
-              self.positions[id] = '{}-{}'.format(ptr + 1, ptr + ln) if ln > 1 else str(ptr + 1)
+                self.positions[id] = position
             ptr += ln
 
     def get_result(self, id):
         if not self.ok:
-            return '', '?'
-        old_pos = self.old_positions.get(id, '?')
-        new_pos = self.positions[id]
-        if old_pos == '?':
-            return '', new_pos
-        op_st, np_st = [int(x.split('-')[0]) for x in [old_pos, new_pos]]
+            return '', '?', None
+        old_pos = self.old_positions.get(id)
+        np_st, new_pos = self.positions[id]
+        if old_pos is None:
+            return '', new_pos, np_st
+        op_st = old_pos[0]
         if op_st > np_st:
-            return '↑', new_pos
+            return '↑', new_pos, np_st
         if op_st < np_st:
-            return '↓', new_pos
-        return '', new_pos
+            return '↓', new_pos, np_st
+        return '', new_pos, np_st
 
     def flush(self):
-        with open('scoreboard.json', 'w') as w:
-            print(json.dumps(self.positions), file = w)
+        write_json('scoreboard.json', self.positions)
 
 
-def main():
-    with open('config.json') as f:
-        config = json.load(f)
+_config_cache = {'mtime': 0, 'data': None}
+
+
+def load_config():
+    mtime = os.stat('config.json').st_mtime
+    if _config_cache['data'] is None or _config_cache['mtime'] != mtime:
+        with open('config.json', 'rb') as f:
+            _config_cache['data'] = orjson.loads(f.read())
+        _config_cache['mtime'] = mtime
+    return _config_cache['data']
+
+
+def main(session=None):
+    config = load_config()
+    if session is None:
+        session = make_session()
 
     contest_start_time = datetime.datetime.strptime(config['contest_start_time'], '%Y-%m-%d %H:%M:%S')
+    contest_start_ts = contest_start_time.timestamp()
 
-    telegram = Telegram(TOKEN)
-    fetcher = DataFetcher(config['fetcher'])
+    telegram = Telegram(TOKEN, session)
+    fetcher = DataFetcher(config['fetcher'], session)
     state = State(config['state'])
 
-    participant_names = {}
-    for participant in config['participants']:
-        participant_names[participant['login']] = participant['name']
+    participants_tbl = [(p['login'], p['name']) for p in config['participants']]
+    problems_tbl = [(p['id'], p.get('fractional_scoring', False), p.get('mute', False), p['name']) for p in config['problems']]
 
-    problem_names = {}
-    use_fractional_scoring = {}
-    problem_muted = {}
-    for problem in config['problems']:
-        problem_names[problem['id']] = problem['name']
-        use_fractional_scoring[problem['id']] = problem.get('fractional_scoring', False)
-        problem_muted[problem['id']] = problem.get('mute', False)
+    participant_names = dict(participants_tbl)
+    problem_names = {problem: name for problem, _, _, name in problems_tbl}
+    fractional_problems = frozenset(problem for problem, fractional, _, _ in problems_tbl if fractional)
+    muted_problems = frozenset(problem for problem, _, muted, _ in problems_tbl if muted)
+    any_fractional = bool(fractional_problems)
 
     submissions = []
     fetch_failed = False
-    for participant in config['participants']:
-        data = fetcher.fetch_data(participant['login'])
+    with ThreadPoolExecutor(max_workers=FETCH_WORKERS) as executor:
+        results = list(executor.map(fetcher.fetch_data, [login for login, _ in participants_tbl]))
+    for data in results:
         if data is None:
             fetch_failed = True
             continue
@@ -237,51 +302,73 @@ def main():
     submissions.sort(key = lambda x: x['time'])
 
     score_upgrades = set()
+    main_batch = []
+    positive_batch = []
 
     for submission in submissions:
         participant, problem = submission['user'], submission['task']
-        fractional_scoring = use_fractional_scoring[problem]
+        fractional_scoring = problem in fractional_problems
         score = formatter(submission['score'], fractional_scoring)
-        submit_time = datetime.datetime.fromtimestamp(submission['time']) - contest_start_time
-        old_score = state.get_points(participant, problem, fractional_scoring)
-        state.add_submission(submission)
-        new_score = state.get_points(participant, problem, fractional_scoring)
+        delta_s = int(submission['time'] - contest_start_ts)
+        sign, delta_s = ('-', -delta_s) if delta_s < 0 else ('', delta_s)
+        submit_time = '{}{}:{:02d}:{:02d}'.format(sign, delta_s // 3600, delta_s % 3600 // 60, delta_s % 60)
+        old_total, new_total = state.add_submission(submission)
+        old_score = formatter(old_total, fractional_scoring)
+        new_score = formatter(new_total, fractional_scoring)
         message = '[{}]: {} submitted {} for {} points\nTotal: {}'.format(submit_time,
                                                                                 participant_names[participant],
                                                                                 problem_names[problem],
                                                                                 score, old_score if old_score == new_score
                                                                                 else '{} -> {}'.format(old_score, new_score))
         print(message, file = sys.stderr)
-        if not problem_muted[problem]:
-            telegram.send_message(config['main_chat'], message)
+        if problem not in muted_problems:
+            main_batch.append(message)
             if old_score != new_score:
                 score_upgrades.add(participant)
-                telegram.send_message(config['positive_chat'], message)
+                positive_batch.append(message)
+
+    telegram.send_messages(config['main_chat'], main_batch)
+    telegram.send_messages(config['positive_chat'], positive_batch)
 
     scores = fetcher.fetch_scores() if not fetch_failed else None
     scoreboard = Scoreboard(scores)
 
     pinned_text_builder = []
-    f, s = itemgetter(0), itemgetter(1)
-
-    problems_ordered = [problem['id'] for problem in config['problems']]
-    for participant in config['participants']:
-        login, name = [participant[x] for x in ['login', 'name']]
-        points = [(state.get_points(login, problem, use_fractional_scoring[problem]), problem) for problem in problems_ordered]
-        diff, result = scoreboard.get_result(login)
-        score = formatter(sum(map(float, map(f, points))), any(use_fractional_scoring.values()))
-        pinned_text_builder.append(('[{}{}] {} ({}{}): {}'.format(diff, result, name, '↑' if login in score_upgrades else '', score, ', '.join(map(f, filter(lambda x : not problem_muted[s(x)], points)))), result))
 
-    if not any(s(x) == '?' for x in pinned_text_builder):
-        pinned_text_builder.sort(key = lambda x : int(s(x).split('-')[0]))
-    pinned_text = '\n'.join(map(f, pinned_text_builder))
+    for login, name in participants_tbl:
+        total = .0
+        cells = []
+        for problem, fractional, muted, _ in problems_tbl:
+            points = state.get_points(login, problem, fractional)
+            total += float(points)
+            if not muted:
+                cells.append(points)
+        diff, result, rank = scoreboard.get_result(login)
+        score = formatter(total, any_fractional)
+        upgrade = '↑' if login in score_upgrades else ''
+        row = f'[{diff}{result}] {name} ({upgrade}{score}): {", ".join(cells)}'
+        pinned_text_builder.append((row, rank))
+
+    if scoreboard.ok:
+        pinned_text_builder.sort(key = itemgetter(1))
+    pinned_text = '\n'.join(map(itemgetter(0), pinned_text_builder))
 
     telegram.edit_pinned_message(config['main_chat'], pinned_text)
     telegram.edit_pinned_message(config['positive_chat'], pinned_text)
     print(pinned_text, file = sys.stderr)
     state.flush()
     telegram.flush()
-    scoreboard.flush()
+    if scoreboard.ok:
+        scoreboard.flush()
 
 if __name__ == '__main__':
-    main()
+    if len(sys.argv) > 1:
+        interval = pytimeparse.parse(sys.argv[1])
+        if interval is None:
+            sys.exit('Bad interval {}'.format(sys.argv[1]))
+        session = make_session()
+        while True:
+            main(session)
+            time.sleep(interval)
+    else:
+        main()
@@ -1,6 +1,6 @@
 #!/bin/bash
 
 while true ; do
-    ./main.py
+    ./main.py 5s
     sleep 5
 done